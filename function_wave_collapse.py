@@ -1,200 +1,409 @@
+import os
 import pygame
-from random import choices
-from typing import Optional, Tuple
+from random import choices, randrange
+from itertools import accumulate
+from collections import deque
 import numpy as np
-from time import time
+from time import perf_counter, perf_counter_ns
 
 DARK_GREEN = (0, 150, 0)
 GREEN = (0, 255, 0)
 BLUE = (0, 0, 255)
 YELLOW = (255, 255, 200)
 GRAY = (100, 100, 100)
+BLACK = (0, 0, 0)
 
 SCREEN_SIZE = (1000, 500)
 TILE_SIZE = (5, 5)
 MAP_SIZE = (SCREEN_SIZE[0]//TILE_SIZE[0], SCREEN_SIZE[1]//TILE_SIZE[1])
 
+# collapse all the most constrained tiles at once instead of one per frame, set the
+# BATCH environment variable to enable
+BATCH_COLLAPSE = bool(os.environ.get("BATCH"))
+BATCH_SPACING = 8
+
+# above this number of changed tiles, the whole screen is redrawn from the type map
+FULL_REDRAW_THRESHOLD = 64
+
+# drawn tiles are pushed to the display at most every DISPLAY_INTERVAL seconds,
+# or as soon as MAX_DIRTY_RECTS of them are waiting
+DISPLAY_INTERVAL = 1/60
+MAX_DIRTY_RECTS = 256
 
-TIMER = {}
 
-def timer(func):
-    def wrapper(*args, **kwargs):
-        func_name = func.__name__
-        total_time = TIMER.get(func_name, 0)
-        t1 = time()
-        value = func(*args, **kwargs)
-        t2 = time()
-        TIMER[func_name] = total_time + t2 - t1
-        return value
-    return wrapper
+# time the functions decorated with @timer, set the PROF environment variable to enable
+PROFILE = bool(os.environ.get("PROF"))
+
+TIMER = {}
+TIMER_FLUSHES = []
+
+if PROFILE:
+    def timer(func):
+        elapsed = 0
+        def wrapper(*args, **kwargs):
+            nonlocal elapsed
+            t1 = perf_counter_ns()
+            value = func(*args, **kwargs)
+            elapsed += perf_counter_ns() - t1
+            return value
+        def flush():
+            TIMER[func.__name__] = elapsed / 1e9
+        TIMER_FLUSHES.append(flush)
+        return wrapper
+else:
+    def timer(func):
+        return func
+
+def flush_timers():
+    """Collect the total time in seconds spent in each timed function into TIMER."""
+    for flush in TIMER_FLUSHES:
+        flush()
+    return TIMER
+
+
+FOREST, MEADOW, BEACH, SEA, MOUNTAINS = range(5)
+
+# one bit per tile type, a set of possible types is stored as an int mask
+ALL_TYPES = 0b11111
+
+ALLOWED_MASK = np.array([
+    0b10011,  # forest: mountains, forest, meadow
+    0b00111,  # meadow: forest, meadow, beach
+    0b01110,  # beach: meadow, beach, sea
+    0b01100,  # sea: beach, sea
+    0b10001,  # mountains: mountains, forest
+], dtype=np.uint8)
+
+# number of set bits of every byte
+POPCOUNT_LUT = np.array([bin(x).count("1") for x in range(256)], dtype=np.uint8)
+
+TYPE_TO_COLOR = {
+    FOREST: DARK_GREEN,
+    MEADOW: GREEN,
+    BEACH: YELLOW,
+    SEA: BLUE,
+    MOUNTAINS: GRAY,
+}
+
+TYPE_WEIGHTS = {
+    MOUNTAINS: 1,
+    FOREST: 1.5,
+    MEADOW: 2,
+    BEACH: 1,
+    SEA: 0.75,
+}
+
+# score of a tile whose type is set, higher than any number of choices
+MAX_SCORE = len(TYPE_TO_COLOR)+1
+
+TYPE_IDS = np.arange(len(TYPE_WEIGHTS), dtype=np.uint8)
+WEIGHTS = np.array([TYPE_WEIGHTS[t] for t in range(len(TYPE_WEIGHTS))])
+
+# normalized cumulative weights of the types contained in each of the 32 possible masks
+CDF_BY_MASK = np.cumsum(((np.arange(ALL_TYPES+1, dtype=np.uint8)[:, None] >> TYPE_IDS) & 1) * WEIGHTS, axis=1)
+CDF_BY_MASK[1:] /= CDF_BY_MASK[1:, -1:]
+
+# types and cumulative weights of the types contained in each mask, for random.choices
+CHOICE_TABLE = []
+for mask in range(ALL_TYPES+1):
+    mask_types = tuple(t for t in range(len(TYPE_WEIGHTS)) if mask >> t & 1)
+    CHOICE_TABLE.append((mask_types, tuple(accumulate(TYPE_WEIGHTS[t] for t in mask_types))))
+
+# types leaving at least one choice to a neighbor with a given choices mask
+SUPPORT_MASK = np.array([
+    sum(1 << t for t in range(len(ALLOWED_MASK)) if ALLOWED_MASK[t] & mask)
+    for mask in range(ALL_TYPES+1)
+], dtype=np.uint8)
+
+# constraint applied by a tile on its neighbors, indexed by type_idx (-1 allows every type)
+PROPAGATION_MASK = np.append(ALLOWED_MASK, np.uint8(ALL_TYPES))
+
+# color of each type, indexed by type_idx (-1 is black)
+PALETTE = np.array([TYPE_TO_COLOR[t] for t in range(len(TYPE_TO_COLOR))] + [BLACK], dtype=np.uint8)
+
+# bytes copies of the lookup tables for step and the score updates, indexing them
+# gives plain ints instead of numpy scalars
+ALLOWED_BYTES = bytes(ALLOWED_MASK)
+SUPPORT_BYTES = bytes(SUPPORT_MASK)
+POPCOUNT_BYTES = bytes(POPCOUNT_LUT)
+
+# tiles are stored in flat arrays and indexed with k = j*MAP_SIZE[0] + i
+TILE_COUNT = MAP_SIZE[0]*MAP_SIZE[1]
+
+# indices of the neighbors of each tile
+NEIGHBORS = []
+for k in range(TILE_COUNT):
+    j, i = divmod(k, MAP_SIZE[0])
+    NEIGHBORS.append(tuple(
+        j1*MAP_SIZE[0] + i1 for (i1, j1) in ((i-1, j), (i, j-1), (i+1, j), (i, j+1))
+        if 0 <= i1 < MAP_SIZE[0] and 0 <= j1 < MAP_SIZE[1]
+    ))
+
+# same table as an array for the batch mode, padded with -1 for tiles with less than 4 neighbors
+NEIGHBOR_TABLE = np.full((TILE_COUNT, 4), -1, dtype=np.int32)
+for k, neighbors in enumerate(NEIGHBORS):
+    NEIGHBOR_TABLE[k, :len(neighbors)] = neighbors
+
+# Grid state, stored as one flat array per field.
+# type_idx is -1 for tiles whose type is not set yet.
+# Choices and scores live in bytearrays, fast to index from Python in step and the
+# bucket helpers, and the numpy arrays are views on the same memory for the batch
+# mode and drawing code.
+choices_buffer = bytearray([ALL_TYPES]) * TILE_COUNT
+scores_buffer = bytearray([POPCOUNT_LUT[ALL_TYPES]]) * TILE_COUNT
+choices_mask = np.frombuffer(choices_buffer, dtype=np.uint8)
+type_idx = np.full(TILE_COUNT, -1, dtype=np.int8)
+score_of = np.frombuffer(scores_buffer, dtype=np.uint8)
+
+# [j, i] views of the grid state for the whole grid operations
+choices_grid = choices_mask.reshape(MAP_SIZE[1], MAP_SIZE[0])
+type_grid = type_idx.reshape(MAP_SIZE[1], MAP_SIZE[0])
+
+# scratch buffer of propagate, holding the constraint applied by each tile
+constraints_grid = np.empty((MAP_SIZE[1], MAP_SIZE[0]), dtype=np.uint8)
+
+# buckets[s] lists the indices of the tiles not set yet with score s,
+# bucket_pos[k] is the position of tile k in its bucket
+buckets = [[] for _ in range(MAX_SCORE)]
+buckets[POPCOUNT_LUT[ALL_TYPES]] = list(range(TILE_COUNT))
+bucket_pos = list(range(TILE_COUNT))
+
+# tiles to check in remove_solitary_tiles, their neighbors are queued again when they change
+solitary_candidates = deque(range(TILE_COUNT))
+
+# candidates skipped while they or their neighbors are not set, queued again once the map is generated
+solitary_pending = []
+
+
+# rect reused to draw every tile
+SCRATCH_RECT = pygame.Rect(0, 0, TILE_SIZE[0], TILE_SIZE[1])
+
+# rects drawn since the last display update
+DIRTY_RECTS = []
+last_display_update = perf_counter()
 
 
 class Tile:
     """
-    Represents a square of terrain, with a specific type and corresponding color.
-    Proximity constraints are applied, forbidding certain types of tiles to be next to one another.
+    View on a square of terrain, used for drawing.
+    The color and position are computed on demand from the grid arrays.
     """
 
-    types = [
-        "forest",
-        "meadow",
-        "beach",
-        "sea",
-        "mountains",
-    ]
-
-    type_to_color = {
-        "forest": DARK_GREEN,
-        "meadow": GREEN,
-        "beach": YELLOW,
-        "sea": BLUE,
-        "mountains": GRAY,
-    }
-
-    allowed_neighbors = {
-        "mountains": {"mountains", "forest"},
-        "forest": {"mountains", "forest", "meadow"},
-        "meadow": {"forest", "meadow", "beach"},
-        "beach": {"meadow", "beach", "sea"},
-        "sea": {"beach", "sea"},
-    }
-
-    type_weights = {
-        "mountains": 1,
-        "forest": 1.5,
-        "meadow": 2,
-        "beach": 1,
-        "sea": 0.75,
-    }
-
-    max_score = len(types)+1
-
-    def __init__(self, i, j):
-        self.i: int = i
-        self.j: int = j
-        self.x: int = TILE_SIZE[0]*i
-        self.y: int = TILE_SIZE[1]*j
-        self.choices: list[str] =  Tile.types
-        self.type: Optional[str] = None
-        self.color: Tuple[int] = (0, 0, 0)
-        self.rect = pygame.Rect(self.x, self.y, TILE_SIZE[0], TILE_SIZE[1])
-    
-    @property
-    def score(self):
-        return Tile.max_score if self.type is not None else len(self.choices)
-    
-    def set_type(self, type):
-        self.type = type
-        self.color = Tile.type_to_color[self.type]
-    
-    def choose_type(self):
-        [type] = choices(self.choices, weights=[Tile.type_weights[c] for c in self.choices])
-        self.set_type(type)
-        return self.type
-    
-    def draw(self):
-        pygame.draw.rect(screen, self.color, self.rect)
+    __slots__ = ("k",)
 
-@timer
-def get_neighbors(i, j):
-    neighbors = []
-    if i > 0:
-        neighbors.append((i-1,j))
-    if j > 0:
-        neighbors.append((i,j-1))
-    if i < MAP_SIZE[0]-1:
-        neighbors.append((i+1,j))
-    if j < MAP_SIZE[1]-1: 
-        neighbors.append((i,j+1))
-    return neighbors
+    def __init__(self, k):
+        self.k: int = k
 
-@timer
-def check_neighbors(tiles, tile_type, neighbors):
-    for (i1, j1) in neighbors:
-        tile = tiles[j1][i1]
-        new_choices = [x for x in tile.choices if x in Tile.allowed_neighbors[tile_type]]
-        if tile.type is None and len(new_choices) == 0:
-            return False
-    return True
+    @property
+    def color(self):
+        return PALETTE[type_idx[self.k]]
 
-@timer
-def update_neighbors(tiles, scores, tile_type, neighbors):
-    for (i1, j1) in neighbors:
-            tile = tiles[j1][i1]
-            tile.choices = [x for x in tile.choices if x in Tile.allowed_neighbors[tile_type]]
-            scores[j1][i1] = tile.score
-    return tiles, scores
+    def draw(self):
+        j, i = divmod(self.k, MAP_SIZE[0])
+        SCRATCH_RECT.x = TILE_SIZE[0]*i
+        SCRATCH_RECT.y = TILE_SIZE[1]*j
+        return pygame.draw.rect(screen, self.color, SCRATCH_RECT)
+
+
+def add_to_bucket(k, score):
+    bucket = buckets[score]
+    bucket_pos[k] = len(bucket)
+    bucket.append(k)
+
+def remove_from_bucket(k, score):
+    # move the last tile of the bucket in place of k
+    bucket = buckets[score]
+    last = bucket.pop()
+    if last != k:
+        position = bucket_pos[k]
+        bucket[position] = last
+        bucket_pos[last] = position
+
+def set_type(k, tile_type):
+    type_idx[k] = tile_type
+    remove_from_bucket(k, scores_buffer[k])
+    scores_buffer[k] = MAX_SCORE
+
+def set_score(k, score):
+    old_score = scores_buffer[k]
+    if score != old_score:
+        remove_from_bucket(k, old_score)
+        add_to_bucket(k, score)
+        scores_buffer[k] = score
 
 @timer
-def choose_tile(scores, minimum):
-    target_tiles = list(zip(*np.where(scores==minimum)))
-    [(j, i)] = choices(target_tiles)
-    return i, j
+def step():
+    """Collapse the most constrained tile and return it, or None once every tile is set."""
+    # chosse a random tile from the tiles with the least possibilities
+    for bucket in buckets:
+        if bucket:
+            break
+    else:
+        return None
+    k = bucket[randrange(len(bucket))]
+    neighbors = NEIGHBORS[k]
+
+    # draw among the types leaving a choice to every unset neighbor, at a dead end fall
+    # back to the tile choices, or to any type when it has none left
+    mask = choices_buffer[k]
+    for k1 in neighbors:
+        if scores_buffer[k1] != MAX_SCORE:
+            mask &= SUPPORT_BYTES[choices_buffer[k1]]
+    mask_types, cum_weights = CHOICE_TABLE[mask or choices_buffer[k] or ALL_TYPES]
+    new_type = choices(mask_types, cum_weights=cum_weights)[0]
+
+    # set the tile and update nearby tile constraints and scores
+    set_type(k, new_type)
+    allowed = ALLOWED_BYTES[new_type]
+    for k1 in neighbors:
+        choices_buffer[k1] &= allowed
+        if scores_buffer[k1] != MAX_SCORE:
+            set_score(k1, POPCOUNT_BYTES[choices_buffer[k1]])
+
+    return Tile(k)
+
+def compile_propagate():
+    """Compile propagate into native loops with numba, or return None if it is not installed."""
+    try:
+        from numba import njit
+    except ImportError:
+        return None
+
+    @njit(cache=True, boundscheck=False)
+    def nb_propagate(mask, type_grid, constraints):
+        height, width = mask.shape
+        for j in range(height):
+            for i in range(width):
+                # the modulo maps type -1 to the last entry of PROPAGATION_MASK
+                constraints[j, i] = PROPAGATION_MASK[type_grid[j, i] % len(PROPAGATION_MASK)]
+        for j in range(height):
+            for i in range(width):
+                m = mask[j, i]
+                if j > 0:
+                    m &= constraints[j-1, i]
+                if j < height-1:
+                    m &= constraints[j+1, i]
+                if i > 0:
+                    m &= constraints[j, i-1]
+                if i < width-1:
+                    m &= constraints[j, i+1]
+                mask[j, i] = m
+
+    return nb_propagate
+
+# importing numba takes longer than the sequential mode runs, only load it for the batch mode
+nb_propagate = compile_propagate() if BATCH_COLLAPSE else None
+
+def propagate(mask):
+    """AND every tile of the [j, i] mask with the constraints of its 4 neighbors."""
+    if nb_propagate is not None:
+        nb_propagate(mask, type_grid, constraints_grid)
+        return
+    # in place uint8 operations on contiguous rows, which numpy runs with SIMD
+    constraints = np.take(PROPAGATION_MASK, type_grid, out=constraints_grid, mode="wrap")
+    mask[1:, :] &= constraints[:-1, :]
+    mask[:-1, :] &= constraints[1:, :]
+    mask[:, 1:] &= constraints[:, :-1]
+    mask[:, :-1] &= constraints[:, 1:]
 
 @timer
-def find_and_update_most_constrained_tile(tiles, scores):
-    minimum = np.min(scores)
-    if minimum == Tile.max_score:
-        return tiles, None, None
-    
-    # chosse a random tile from the tiles with the least possibilities    
-    i, j = choose_tile(scores, minimum)
-
-    # update the tile
-    tile = tiles[j][i]
-    neighbors = get_neighbors(i,j)
-    valid = False
-    while not valid:
-        new_type = tile.choose_type()
-        valid = check_neighbors(tiles, new_type, neighbors)
-        if not valid:
-            tile.choices.remove(new_type)
-
-    tile.draw()
-    scores[j][i] = tile.score
-
-    # update nearby tile constraints and scores
-    tiles, scores = update_neighbors(tiles, scores, new_type, neighbors)
-
-    return tiles, scores, tile
+def collapse_most_constrained_tiles():
+    minimum = np.min(score_of)
+    if minimum == MAX_SCORE:
+        return None
+
+    ks = np.flatnonzero(score_of == minimum)
+    first = np.random.randint(len(ks))
+    if minimum == POPCOUNT_LUT[ALL_TYPES]:
+        # nothing constrains the grid yet, start from a single seed tile
+        ks = ks[[first]]
+    else:
+        # keep candidates spaced by BATCH_SPACING tiles around a random one, so that the
+        # constraints they add do not meet before the tiles in between are collapsed
+        js, is_ = np.divmod(ks, MAP_SIZE[0])
+        spaced = ((is_ - is_[first]) % BATCH_SPACING == 0) & ((js - js[first]) % BATCH_SPACING == 0)
+        ks = ks[spaced]
+
+    # like step, keep the types leaving a choice to every neighbor,
+    # missing neighbors of border tiles and tiles already set allow every type
+    neighbors = NEIGHBOR_TABLE[ks]
+    neighbor_choices = np.where(
+        (neighbors >= 0) & (type_idx[neighbors] < 0), choices_mask[neighbors], ALL_TYPES
+    )
+    tile_choices = choices_mask[ks]
+    masks = tile_choices & np.bitwise_and.reduce(SUPPORT_MASK[neighbor_choices], axis=1)
+    masks = np.where(masks, masks, np.where(tile_choices, tile_choices, ALL_TYPES))
+
+    # draw a weighted random type for every candidate among its placeable types
+    r = np.random.random(len(ks))
+    new_types = (CDF_BY_MASK[masks] <= r[:, None]).sum(axis=1)
+    type_idx[ks] = new_types
+
+    propagate(choices_grid)
+
+    # keep the scores and buckets in sync with the new choices, only the neighbors of the
+    # new tiles can have changed
+    for (k, tile_type) in zip(ks.tolist(), new_types.tolist()):
+        set_type(k, tile_type)
+    changed = np.unique(neighbors[neighbors >= 0])
+    for k in changed[type_idx[changed] < 0].tolist():
+        set_score(k, POPCOUNT_BYTES[choices_buffer[k]])
+
+    return [Tile(k) for k in ks.tolist()]
+
+def draw_map():
+    rgb = PALETTE[type_grid]
+    rgb = np.repeat(np.repeat(rgb, TILE_SIZE[1], axis=0), TILE_SIZE[0], axis=1)
+    pygame.surfarray.blit_array(screen, rgb.transpose(1, 0, 2))
 
 @timer
-def update_screen(tile):
-    if tile is not None:
-        pygame.display.update(tile.rect)
-    
-
-def remove_solitary_tiles(tiles, tile_start=0):
-    flat_tiles = [tile for row in tiles for tile in row]
-    for tile_num, tile in enumerate(flat_tiles[tile_start:]):
-        neighboring_tiles = [tiles[j2][i2] for (i2,j2) in get_neighbors(tile.i, tile.j)]
-        if tile.type == neighboring_tiles[0].type:
+def update_screen(tiles):
+    global last_display_update
+    if len(tiles) > FULL_REDRAW_THRESHOLD:
+        draw_map()
+        pygame.display.flip()
+        DIRTY_RECTS.clear()
+        last_display_update = perf_counter()
+        return
+
+    DIRTY_RECTS.extend(tile.draw() for tile in tiles)
+    now = perf_counter()
+    if DIRTY_RECTS and (now - last_display_update > DISPLAY_INTERVAL or len(DIRTY_RECTS) > MAX_DIRTY_RECTS):
+        pygame.display.update(DIRTY_RECTS)
+        DIRTY_RECTS.clear()
+        last_display_update = now
+
+
+def remove_solitary_tiles():
+    local_type_idx, local_neighbors = type_idx, NEIGHBORS
+    while solitary_candidates:
+        k = solitary_candidates.popleft()
+        neighbor_types = [local_type_idx[k1] for k1 in local_neighbors[k]]
+        if local_type_idx[k] < 0 or min(neighbor_types) < 0:
+            solitary_pending.append(k)
+            continue
+        if local_type_idx[k] == neighbor_types[0]:
             continue
-        neighbor_types = set(neighbor.type for neighbor in neighboring_tiles)
-        if len(neighbor_types) == 1:
-            tile.set_type(list(neighbor_types)[0])
-            tile.draw()
-            return tiles, tile, tile_num+tile_start
-    return None, None, None
+        if len(set(neighbor_types)) == 1:
+            local_type_idx[k] = neighbor_types[0]
+            solitary_candidates.extend(local_neighbors[k])
+            return Tile(k)
+    return None
 
 
 if __name__ == "__main__":
-    
+
     pygame.init()
 
     pygame.display.set_caption("Procedural Generation")
     screen = pygame.display.set_mode(SCREEN_SIZE)
     screen.fill((0, 0, 0))
-    
+
     # Main Loop
     clock = pygame.time.Clock()
     RUN = True
     UPDATE = False
-
-    # Set up simulation
-    tiles = [[Tile(i, j) for i in range(MAP_SIZE[0])] for j in range(MAP_SIZE[1])]
-    scores = np.array([[tile.score for tile in row] for row in tiles])
-    tile_start = 0
+    GENERATE = True
 
     while RUN:
         for event in pygame.event.get():
@@ -203,16 +412,33 @@ if __name__ == "__main__":
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_RETURN:
                     UPDATE = True
-        
-        if scores is not None:
-            tiles, scores, updated_tile = find_and_update_most_constrained_tile(tiles, scores)
-            update_screen(updated_tile)
-
-        if UPDATE and tiles is not None:
-            tiles, updated_tile, tile_start = remove_solitary_tiles(tiles, tile_start)
-            update_screen(updated_tile)
 
-    print(TIMER)
+        updated_tiles = []
+
+        if GENERATE and BATCH_COLLAPSE:
+            collapsed_tiles = collapse_most_constrained_tiles()
+            GENERATE = collapsed_tiles is not None
+            updated_tiles += collapsed_tiles or []
+        elif GENERATE:
+            updated_tile = step()
+            GENERATE = updated_tile is not None
+            updated_tiles += [updated_tile] if GENERATE else []
+
+        if UPDATE:
+            if not GENERATE:
+                # the tiles skipped during the generation can be checked now
+                solitary_candidates.extend(solitary_pending)
+                solitary_pending.clear()
+            updated_tile = remove_solitary_tiles()
+            # keep going until the generation is done and the skipped tiles are checked
+            UPDATE = updated_tile is not None or GENERATE
+            updated_tiles += [updated_tile] if updated_tile is not None else []
+
+        # called on every frame so that the last drawn tiles are displayed
+        update_screen(updated_tiles)
+
+    if PROFILE:
+        print(flush_timers())
 
     # Exit main loop
     pygame.quit()